@@ -1,76 +1,35 @@
 #!/usr/bin/env python3
 
-# lock intended to use for analysis in a separate process
-# (want a proper thread/process-safe lock)
-from multiprocessing import Lock
-
-# to deeply copy measurements from ringbufs
-from copy import deepcopy # not used?
-
 import datetime
+from functools import lru_cache
+# measurements live in shared memory so analysis in another process can
+# read them without pickling/copying them over
+from multiprocessing import shared_memory
+
+import numpy as np
 
 # goal is to be a container for our active-use signal measurements,
 # as well as holder of 'global' config & state to enable analysis
 # and monitoring
 class SignalStore:
 
-	# purpose-built class to help us have a ring buffer.
-	# a ring buffer fills up with data, then when we reach the end
-	# and it's full, we wrap back around to the beginning and overwrite
-	# the oldest data.
-	# You shouldn't have to touch this.
-	class _ringbuf:
-
-		# size: size in elements of ringbuf
-		# 	we want this large enough to contain a full second of data
-		def __init__(self, size):
-			self._size = size
-			self._cursor = 0
-			# TODO: could probably replace with a faster structure
-			self._data = []
-			self._full = False
-			self._lock = Lock()
-
-		def add(self, val):
-			with self._lock:
-				if self._full:
-					self._data[self._cursor] = val
-					self._cursor = (self._cursor + 1) % len(self._data)
-				else:
-					self._data.append(val)
-					if len(self._data) >= self._size:
-						self._full = True
-
-		def get_data_copy(self):
-			with self._lock:
-				if self._full:
-					# slices make shallow copies
-					data = self._data[self._cursor:] + self._data[:self._cursor]
-					# proper deep copy so data can't be changed
-					# and mix up analyzing or other users
-					# (unnecessary if using basic types)
-					#return deepcopy(data)
-					return data
-				else:
-					return self._data.copy()
-		# unused
-		def is_full(self):
-			return self._full
-
-		# removed dead code: oldest entry at 0 or self._cursor,
-		# newest entry at -1 or self._cursor - 1
-
 	# config: opaque object to store global config (bad design)
 	def __init__(self, config):
-		# map lowest frequency of bucket to ringbuf of most recent measurements
+		# Measurements are kept as a ring buffer per frequency bucket, all
+		# packed in one matrix: one row per bucket (lowest frequency first),
+		# one column per ringbuf slot. A ring buffer fills up with data,
+		# then when we reach the end and it's full, we wrap back around to
+		# the beginning and overwrite the oldest data.
+		# Only the signal strength (dB) is kept; the frequency of each row
+		# lives in a separate array, since it never changes.
 
 		# Want to guarantee that we have ~1s of measurements in ringbuf,
 		# realistically between 1 and 2 seconds worth, since granularity
 		# of given measurements is one second
 		# do a warmup period of measurements. Pick a frequency bucket
 		# (first one we see) and count the number of measurements we get
-		# for it to elapse one entire second. Then set our ringbufs to that
-		# size (which requires remapping ringbufs...)
+		# for it to elapse one entire second. Then size our ringbufs to
+		# that, once we've also seen every bucket hackrf_sweep reports.
 		# TODO: do health checks based on this to see
 		# 1) if we aren't getting enough new measurements
 		# 2) if we're getting too many new measurements
@@ -78,7 +37,24 @@ class SignalStore:
 		# TODO: can have a separate ringbuf for each second. Use current
 		# ringbuf (possibly incomplete) and most recent (at least 1s worth)
 		# while tossing older ringbufs
-		self._ranges = {}
+
+		# dB measurements, [bucket, ringbuf slot]. Slots not written yet are NaN
+		# No lock: there's a single producer (the parsing loop), and readers
+		# only take a snapshot, so a torn read costs at most one slot.
+		self._db = None
+		# shared memory backing self._db, and whether we're the one
+		# responsible for freeing it
+		self._shm = None
+		self._owns_shm = False
+		# lowest frequency of the first row's bucket. hackrf_sweep covers
+		# its range with no gaps, so bucket with lowest frequency f is
+		# row (f - self._base_hz) // bucket width
+		self._base_hz = None
+		self._n_buckets = None
+		# full range [min, max) of each row's bucket, one row per bucket
+		self._bucket_ranges = None
+		# next ringbuf slot to write, for each row
+		self._cursors = None
 
 		self._BUFSIZE = 200
 		self._bucket_width = None
@@ -89,6 +65,9 @@ class SignalStore:
 		self._warmup_bucket_frequency = 0
 		self._warmup_first_datetime = 0
 		self._warmup_resize_ringbufs = False
+		# lowest & highest frequency seen during warmup
+		self._warmup_hz_low = None
+		self._warmup_hz_high = None
 
 	def is_warmed_up(self):
 		return self._warmed_up
@@ -98,117 +77,172 @@ class SignalStore:
 			return self._bucket_width
 		else:
 			raise Exception("no measurements yet, unknown bucket width!")
-	
-	# get 'snapshot' copy of signals for analysis without blocking further parsing
-	def get_measurements_copy(self):
-		copy = {}
 
-		for k in self._ranges.keys():
-			copy[k] = self._ranges[k].get_data_copy()
-
-		return copy
+	# full range [min, max) of each bucket, in the same (ascending) order
+	# as the rows of get_measurements_copy(). Buckets are fixed for
+	# hackrf_sweep's runtime, so this is computed once after warmup.
+	def get_bucket_ranges(self):
+		if self._bucket_ranges is not None:
+			return self._bucket_ranges
+		else:
+			raise Exception("not warmed up yet, unknown bucket ranges!")
 
-	# given list of Measurement objects, add them to our
-	# ringbufs of measured signals.
-	# This includes warmup logic, which we use to dynamically resize our
+	# get 'snapshot' copy of signals for analysis without blocking further parsing
+	# returns matrix of dB, one row per bucket, one column per ringbuf slot
+	# (slots are in no particular order; unwritten slots are NaN)
+	def get_measurements_copy(self):
+		return self._db.copy()
+
+	# make our ringbufs once warmup tells us how many buckets there are
+	# and how many measurements a second holds
+	def _allocate_ringbufs(self):
+		self._base_hz = self._warmup_hz_low
+		self._n_buckets = (self._warmup_hz_high - self._base_hz) // self._bucket_width
+		hz_low = self._base_hz + self._bucket_width * np.arange(self._n_buckets, dtype=np.int64)
+		self._bucket_ranges = np.stack((hz_low, hz_low + self._bucket_width), axis=1)
+		nbytes = self._n_buckets * self._BUFSIZE * np.dtype(np.float32).itemsize
+		self._shm = shared_memory.SharedMemory(create=True, size=nbytes)
+		self._owns_shm = True
+		self._db = self._view_shm()
+		self._db.fill(np.nan)
+		self._cursors = np.zeros(self._n_buckets, dtype=np.int64)
+
+	# numpy view of our measurements in shared memory (no copy)
+	def _view_shm(self):
+		return np.ndarray((self._n_buckets, self._BUFSIZE), dtype=np.float32, buffer=self._shm.buf)
+
+	# when handed to another process (e.g. for analysis), only the name of
+	# our shared memory is sent; the other process maps the same measurements
+	def __getstate__(self):
+		state = self.__dict__.copy()
+		del state['_db']
+		state['_owns_shm'] = False
+		return state
+
+	def __setstate__(self, state):
+		self.__dict__.update(state)
+		self._db = None
+		if self._shm:
+			self._db = self._view_shm()
+
+	# release shared memory. The store can't be used afterwards.
+	def close(self):
+		if not self._shm:
+			return
+		# drop our view first, shared memory can't close while it's in use
+		self._db = None
+		self._shm.close()
+		if self._owns_shm:
+			self._shm.unlink()
+		self._shm = None
+
+	# given a parsed line of hackrf_sweep output, add its measurements
+	# (contiguous buckets starting at hsl.hz_low) to our ringbufs of
+	# measured signals.
+	# This starts out as warmup logic, which we use to dynamically size our
 	# ringbufs to hold approximately 1 second of measurements. This way
 	# our whole analysis process only focuses on the most recent second
-	# of signals.
-	# measurements: list of Measurement objects
-	def add_measurements(self, measurements):
+	# of signals. Once warmed up, self.add_sweep_line is swapped for the
+	# method that stores lines (or drops them, if we're skipping analysis),
+	# so no per-line check of which to do is needed.
+	# hsl: HackSweepLine
+	def add_sweep_line(self, hsl):
 		# if we haven't observed a bucket size yet, note it
 		# (it should be fixed for all buckets, over hackrf_sweep's runtime)
 		if not self._bucket_width:
-			m = measurements[0]
-			self._bucket_width = m.hz_high - m.hz_low
+			# NOTE: this should always be a legitimate int, but it would be nice
+			# to tell if it isn't
+			self._bucket_width = int(hsl.hz_bin_width)
+			if self._bucket_width != hsl.hz_bin_width:
+				raise Exception("non-integer bin width for measurements")
 
 		# pick arbitrary bucket to watch for timing the warmup process
 		# (first bucket)
 		if not self._warmup_bucket_frequency:
-			self._warmup_bucket_frequency = measurements[0].hz_low
-			self._warmup_first_datetime = measurements[0].datetime
+			self._warmup_bucket_frequency = hsl.hz_low
+			self._warmup_first_datetime = hsl.datetime
 
 		# check for resize signal & complete warmup process
-		if not self.is_warmed_up() and self._warmup_resize_ringbufs:
+		if self._warmup_resize_ringbufs:
 			self._warmup_resize_ringbufs = False
-			# resize
 			print(f"[I] (warmup) resizing ringbufs to {self._warmup_measurement_count} elements")
 			self._BUFSIZE = self._warmup_measurement_count
-			# race condition here, but add_measurement is only ever
-			# called from single thread right now, so safe. All ringbufs
-			# will be destroyed before another measurement is added
-			tmpkeys = list(self._ranges.keys())
-			for k in tmpkeys:
-				del(self._ranges[k])
-			# let usual add process create new ringbuf objects
+			if self.config['skip_analysis']:
+				# benchmarking parsing; nothing will read measurements,
+				# so don't bother making the ringbufs
+				self.add_sweep_line = self._drop_sweep_line
+			else:
+				self._allocate_ringbufs()
+				self.add_sweep_line = self._store_sweep_line
 			self._warmed_up = True
-
-		one_second = datetime.timedelta(seconds=1)
-		for m in measurements:
-			# warmup logic, for dynamically resizing ringbuf to have
-			# roughly 1s of measurements
-			if not self.is_warmed_up() and \
-				self._warmup_bucket_frequency == m.hz_low:
-				self._warmup_measurement_count += 1
-
-				# if first time more than one second has elapsed
-				# set flag to signal for resize process to
-				# complete warmup
-				if m.datetime - self._warmup_first_datetime > one_second:
-					self._warmup_resize_ringbufs = True
-
-			# typical case
-			try:
-				self._ranges[m.hz_low].add(m)
-			except KeyError:
-				# haven't seen this bucket yet; make ringbuf (first time)
-				self._ranges[m.hz_low] = self._ringbuf(self._BUFSIZE)
-				self._ranges[m.hz_low].add(m)
-
+			self.add_sweep_line(hsl)
+			return
+
+		# warmup logic, for dynamically sizing ringbufs to have
+		# roughly 1s of measurements. Measurements taken during
+		# warmup aren't kept.
+		hz_high = hsl.hz_low + len(hsl.samples) * self._bucket_width
+		if self._warmup_hz_low is None or hsl.hz_low < self._warmup_hz_low:
+			self._warmup_hz_low = hsl.hz_low
+		if self._warmup_hz_high is None or hz_high > self._warmup_hz_high:
+			self._warmup_hz_high = hz_high
+
+		if self._warmup_bucket_frequency == hsl.hz_low:
+			self._warmup_measurement_count += 1
+
+			# if first time more than one second has elapsed
+			# set flag to signal for resize process to
+			# complete warmup
+			if hsl.datetime - self._warmup_first_datetime > datetime.timedelta(seconds=1):
+				self._warmup_resize_ringbufs = True
+
+	# add_sweep_line once warmed up: typical case
+	def _store_sweep_line(self, hsl):
+		# every bucket in a line is measured together, so they share a cursor
+		start = (hsl.hz_low - self._base_hz) // self._bucket_width
+		end = start + len(hsl.samples)
+		cursor = self._cursors[start]
+		self._db[start:end, cursor] = hsl.samples
+		self._cursors[start:end] = (cursor + 1) % self._BUFSIZE
+
+	# add_sweep_line once warmed up, when skipping analysis
+	def _drop_sweep_line(self, hsl):
+		pass
+
+
+# turn hackrf_sweep's date & time fields into a datetime
+# Every line within a second repeats the same timestamp, so remember the
+# last couple we've parsed rather than building a new datetime each line.
+# date: YYYY-MM-DD
+# time: hh:mm:ss (possibly with leading whitespace)
+@lru_cache(maxsize=2)
+def _parse_datetime(date, time):
+	# the format is fixed, so slice out the numbers ourselves
+	# instead of having strptime parse a format
+	return datetime.datetime(
+		int(date[0:4]), int(date[5:7]), int(date[8:10]),
+		int(time[-8:-6]), int(time[-5:-3]), int(time[-2:]))
 
 # Parse a line of output from hackrf_sweep, produce measurements from it
 class HackSweepLine:
+	# one of these is made per line of input; slots skip allocating an
+	# attribute dict for each
+	__slots__ = ('datetime', 'hz_low', 'hz_high', 'hz_bin_width', 'num_samples', 'samples')
+
+	# line: bytes, as read from hackrf_sweep (no need to decode to str)
 	def __init__(self, line):
-		fields = line.split(',')
+		# only split off the 6 header fields; the rest of the line is samples
+		fields = line.split(b',', 6)
 
 		# TODO: using datetime types would be nice
-		tmp_date = fields.pop(0)
-		tmp_time = fields.pop(0)
-		tmp_datetime = tmp_date + ' ' + tmp_time
-		self.datetime = datetime.datetime.strptime(tmp_datetime, '%Y-%m-%d %H:%M:%S')
-		self.hz_low = int(fields.pop(0))
-		self.hz_high = int(fields.pop(0))
-		self.hz_bin_width = float(fields.pop(0))
-		self.num_samples = int(fields.pop(0))
-		self.samples = [float(db) for db in fields]
-
-	# produce a measurement of each bucket in this line
-	# returns a list of measurements (arbitrary length)
-	def to_measurements(self):
-		# NOTE: this should always be a legitimate int, but it would be nice
-		# to tell if it isn't
-		num_buckets = int( (self.hz_high - self.hz_low) / self.hz_bin_width )
-		hz_bin_width = int(self.hz_bin_width)
-
-		if hz_bin_width != self.hz_bin_width:
-			raise Exception("non-integer bin width for measurements")
-
-		# get each bucket's measurement 
-		i = 0
-		measurements = []
-		for f in range(self.hz_low, self.hz_high, hz_bin_width):
-			m = Measurement(self.datetime, f, f + hz_bin_width, self.samples[i])
-			i += 1
-			measurements.append(m)
-
-		return measurements
-
-class Measurement:
-	def __init__(self, datetime, hz_low, hz_high, db):
-		self.datetime = datetime
-		self.hz_low = hz_low
-		self.hz_high = hz_high
-		self.db = db
+		self.datetime = _parse_datetime(fields[0], fields[1])
+		self.hz_low = int(fields[2])
+		self.hz_high = int(fields[3])
+		self.hz_bin_width = float(fields[4])
+		self.num_samples = int(fields[5])
+		# dB of each bucket in [hz_low, hz_high), lowest frequency first
+		# (parsed by numpy in C rather than float() on each field)
+		self.samples = np.fromstring(fields[6], sep=',', dtype=np.float32)
 
 if __name__ == '__main__':
 	# this should only be imported
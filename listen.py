@@ -16,26 +16,32 @@
 # or get clever...
 
 import argparse
-from multiprocessing import Process
+import io
+from multiprocessing import Process, Queue
 import sys
 import time
 
-from hackrf_sweep_classes import HackSweepLine, Measurement, SignalStore
+import numpy as np
+
+from hackrf_sweep_classes import HackSweepLine, SignalStore
 
 # estimate current environmental noise floor based on averages of buckets
-# average_bucket_strengths: dict mapping min frequency of a bucket, to average observed signal strength
+# average_bucket_strengths: array of average observed signal strength of each bucket
 def compute_noise_floor(average_bucket_strengths):
 
 	# just an estimate (not sure if there's a canonical algorithm for this)
 	# take weakest 25% of signals, and average just those.
-	sorted_dbs = sorted(average_bucket_strengths.values())
-	quarter_len = len(sorted_dbs) // 4
-	noise_floor = sum( sorted_dbs[:quarter_len] ) / quarter_len
+	# (partition only puts the weakest quarter first, no full sort needed)
+	quarter_len = len(average_bucket_strengths) // 4
+	weakest_dbs = np.partition(average_bucket_strengths, quarter_len)[:quarter_len]
+	noise_floor = weakest_dbs.mean()
 
 	return noise_floor
 
 # given signal strengths by bucket, and a noise floor, compute which buckets
-# have a signal, and what that signal strength is
+# have a signal
+# returns boolean array of which buckets have a signal (their strengths
+# are just average_bucket_strengths[has_signal], no need to copy them out)
 def find_signal_buckets(average_bucket_strengths, noise_floor):
 
 	# dB above noise floor at which point we consider something a "signal"
@@ -44,72 +50,40 @@ def find_signal_buckets(average_bucket_strengths, noise_floor):
 	# case successfully had the video downlink detected
 	SQUELCH = 3
 
-	# TODO: turn this into a dict?
-	has_signal = []
-	signal_strengths = []
-	for k in sorted(average_bucket_strengths.keys()):
-		if average_bucket_strengths[k] > noise_floor + SQUELCH:
-			# has_signal is given signals sorted by frequency (and thus bucket)
-			# indices match between has_signal and signal_strengths (in order with each other)
-			# TODO: making this a dict will be nicer, since then we won't
-			# have to be so careful in making sure the indices match up
-			has_signal.append(k)
-			signal_strengths.append(average_bucket_strengths[k])
-
-	return (has_signal, signal_strengths)
-
-# given a list of buckets which have signal, return a list of the frequency ranges
-# which are contiguous
-def get_contiguous_regions(bucket_width, bucket_ranges, has_signal, signal_strengths):
+	has_signal = average_bucket_strengths > noise_floor + SQUELCH
+
+	return has_signal
+
+# given which buckets have signal, return an array of the frequency ranges
+# [min, max) which are contiguous, one row per range
+# bucket_ranges: array of each bucket's [min, max), one row per bucket
+# has_signal: boolean array of which buckets have a signal
+# NOTE: this assumes buckets are sorted by frequency, with no gaps between them
+def get_contiguous_regions(bucket_ranges, has_signal):
 	# need to look for contiguous buckets with signal that are 10MHz or 20MHz wide (or wider?)
-	# walk has_signal array and get full bucket ranges
-	# NOTE: this assumes that has_signal is sorted
-	signal_ranges = [ bucket_ranges[f] for f in has_signal ]
-	# tally width of contiguous signal ranges
-	contiguous_regions = [] # tuple of [min, max)
-	i = 0
-	if len(signal_ranges) > 2:
-		while True:
-			# initial contiguous region is this bucket (by definition)
-			# (a single bucket on its own is contiguous with itself)
-			start = signal_ranges[i][0]
-			end = signal_ranges[i][1]
-
-			# find the end of this contiguous region
-			# ranges are [a, b), [c, d), so contiguous iff. b == c
-			while signal_ranges[i][1] == signal_ranges[i+1][0]:
-				end = signal_ranges[i+1][0]
-				i += 1
-
-				# end case (no more signals)
-				if i >= len(signal_ranges) - 1:
-					break
-
-			# [start, end) now reflects a contiguous region
-			contiguous_regions.append( (start, end) )
-			i += 1
-
-			# end case (no more signals)
-			if i >= len(signal_ranges) - 1:
-				break
+	# pad with "no signal" on both ends so every region has a rising edge
+	# (0 -> 1) where it starts and a falling edge (1 -> 0) just past its end
+	edges = np.diff(np.concatenate(([0], has_signal.view(np.int8), [0])))
+	starts = np.flatnonzero(edges == 1)
+	ends = np.flatnonzero(edges == -1)
+
+	contiguous_regions = np.stack((bucket_ranges[starts, 0], bucket_ranges[ends - 1, 1]), axis=1)
 
 	return contiguous_regions
 
 # get the regions of contiguous signal which are wide enough to
 # be considered drone video downlinks
 def get_drone_regions(contiguous_signal_regions):
-	BANDWIDTH_THRESHOLD = 10000 # 10MHz
+	BANDWIDTH_THRESHOLD = 10000000 # 10MHz
 
-	drone_regions = []
-	for r in contiguous_signal_regions:
-		if r[1] - r[0] > BANDWIDTH_THRESHOLD:
-			drone_regions.append(r)
-	return drone_regions
+	# a 10MHz downlink is the narrowest we look for, so it has to count
+	widths = contiguous_signal_regions[:, 1] - contiguous_signal_regions[:, 0]
+	return contiguous_signal_regions[widths >= BANDWIDTH_THRESHOLD]
 
 # analyze range of measurements
 # if there's a constant 10 MHz or 20 MHz bandwith signal, assume it's a drone.
 # If not, assume no drone
-# ranges: dict mapping lowest frequency of bucket to list of measurements
+# signal_store: SignalStore with measurements of each bucket
 #
 # rough detection heuristic: lowest signal strengths probably decent candidates
 # for the noise floor. Take avg of lowest quarter of measurements?
@@ -129,40 +103,58 @@ def analyze(signal_store):
 	# get 'frozen' copy of data to analyze
 	measurements = signal_store.get_measurements_copy()
 
-	# map min frequency of bucket to average signal strength in dB
-	averages = {}
-	# go from lowest frequency to highest
-	for f in sorted(measurements.keys()):
-		ms = measurements[f]
-		# compute and store the average signal strength for this frequency bucket
-		# (smooths out signal spikes)
-		if len(ms) != 0:
-			avg_db = sum( [ m.db for m in ms ] ) / len(ms)
-			averages[f] = avg_db
-			#print(f"[I] {f = }: {avg_db}") # debug
+	# compute the average signal strength for each frequency bucket
+	# (smooths out signal spikes). Ringbuf slots not filled yet are NaN.
+	averages = np.nanmean(measurements, axis=1)
+	#print(f"[I] {averages = }") # debug
 	
 	noise_floor = compute_noise_floor(averages)
 
 	# find which frequency ranges have a signal
-	(has_signal, signal_strengths) = find_signal_buckets(averages, noise_floor)
+	has_signal = find_signal_buckets(averages, noise_floor)
 	
 	# check for contiguous ranges of detected signals
-	bucket_width = signal_store.get_bucket_width()
-	# map min frequency of bucket to full range of bucket [min, max)
+	# full range of each bucket [min, max), in the same order as averages
 	# thus, contiguous iff i[max] == i+1[min]
-	bucket_ranges = { f: (f, f + bucket_width) for f in averages.keys() }
+	bucket_ranges = signal_store.get_bucket_ranges()
 
-	contiguous_regions = get_contiguous_regions(bucket_width, bucket_ranges, has_signal, signal_strengths)
+	contiguous_regions = get_contiguous_regions(bucket_ranges, has_signal)
 
 	# see if any contiguous regions are wide enough to assume they're a video downlink
 	drone_regions = get_drone_regions(contiguous_regions)
 	drone_detected = False
-	if drone_regions:
+	if len(drone_regions) > 0:
 		drone_detected = True
 
-	#print(f"[I] signal buckets {len(has_signal)}, {now = }, {noise_floor = :0.1f}, {has_signal = }, {signal_strengths = }, {signal_ranges = }, {contiguous_regions = }") # debug
+	#print(f"[I] signal buckets {has_signal.sum()}, {now = }, {noise_floor = :0.1f}, {has_signal = }, {averages[has_signal] = }, {contiguous_regions = }") # debug
 	print(f"[I] {drone_detected = }")
 
+# long-lived analysis process, so we don't pay for starting a new
+# process each second. Analyzes the latest measurements every time the
+# parsing loop says another second has gone by.
+# signal_store: SignalStore whose measurements are shared with the parsing loop
+# analysis_queue: datetime of each new second, None when there's no more input
+def analysis_loop(signal_store, analysis_queue):
+	while True:
+		# newest second queued, if any
+		last_second = None
+		item = analysis_queue.get()
+		# measurements are shared live, so if we've fallen behind, every
+		# second still queued would analyze the same (newest) data.
+		# Catch up and analyze once. empty() is only advisory, so this may
+		# stop draining early; that just costs one extra analysis.
+		while item is not None:
+			last_second = item
+			if analysis_queue.empty():
+				break
+			item = analysis_queue.get()
+
+		if last_second is not None:
+			#print(f'[I] running analysis for {last_second}') # debug
+			analyze(signal_store)
+		if item is None:
+			return
+
 # read hackrf_sweep output from a file
 # kick off periodic analyzing by line count
 # for debugging
@@ -174,30 +166,37 @@ def handle_input(store):
 	# maps frequency bucket (indexed by lowest frequency) to list of measurements
 	# janky attempt to analyze once a second
 	last_datetime = None
-	while True:
-		line = sys.stdin.readline()
-		if not line:
-			break
-
-		# parse measurements & add to our measurements buffer
-		hsl = HackSweepLine(line)
-		measurements = hsl.to_measurements()
-		store.add_measurements(measurements)
+	# started once measurements are in shared memory (after warmup)
+	analysis_process = None
+	analysis_queue = Queue()
+	# hackrf_sweep output is plain ASCII, so read raw bytes rather than
+	# decoding every line to str, with a big buffer to cut down on reads
+	reader = io.BufferedReader(sys.stdin.buffer.raw, buffer_size=1 << 20)
+	try:
+		for line in iter(reader.readline, b''):
+			# parse measurements & add to our measurements buffer
+			hsl = HackSweepLine(line)
+			store.add_sweep_line(hsl)
 		
-		if not last_datetime:
-			last_datetime = hsl.datetime
-
-		# do drone check once a second
-		# (hackrf_sweep has 1s granularity on timestamps)
-		if hsl.datetime != last_datetime:
-			# TODO: would be nice to have a longer-lived analysis
-			# process to avoid startup cost of a new process for
-			# each analysis
-			last_datetime = hsl.datetime
-			#print(f'[I] running analysis for {hsl.datetime}') # debug
-			if store.is_warmed_up():
-				Process(target=analyze, args=(store,)).start()
-	pass
+			if not last_datetime:
+				last_datetime = hsl.datetime
+
+			# do drone check once a second
+			# (hackrf_sweep has 1s granularity on timestamps)
+			if hsl.datetime != last_datetime:
+				last_datetime = hsl.datetime
+				if store.is_warmed_up():
+					if not analysis_process:
+						analysis_process = Process(target=analysis_loop, args=(store, analysis_queue))
+						analysis_process.start()
+					# never wait on analysis; parsing has to keep up with hackrf_sweep
+					analysis_queue.put_nowait(hsl.datetime)
+	finally:
+		# let analysis finish up before we go. Even if parsing failed, the
+		# analysis process must be told to stop, or it'd keep us from exiting
+		if analysis_process:
+			analysis_queue.put(None)
+			analysis_process.join()
 
 if __name__ == '__main__':
 	# note: over the time of hackrf_sweep running, it won't change configuration
@@ -214,7 +213,7 @@ if __name__ == '__main__':
 
 	parser = argparse.ArgumentParser(description='listen to hackrf_sweep output for drone video downlink signals')
 	parser.add_argument('-f', '--file', help='a file to read data from (from hackrf_sweep > file')
-	parser.add_argument('--skip-analysis', action='store_const', const=True, help='skip analysis to benchmark parsing & data storing/retrieval')
+	parser.add_argument('--skip-analysis', action='store_const', const=True, help='skip storing measurements & analysis, to benchmark parsing')
 
 	args = parser.parse_args()
 
@@ -225,4 +224,7 @@ if __name__ == '__main__':
 		handle_file(args.file)
 	else:
 		# read input from stdin (assume live hackrf_sweep instance)
-		handle_input(store)
+		try:
+			handle_input(store)
+		finally:
+			store.close()
@@ -4,35 +4,35 @@
 # it to simulate a live-running hackrf_sweep instance
 
 import argparse
+import sys
 import time
 
 from hackrf_sweep_classes import HackSweepLine
 
 # 2nd field is time (hh:mm:ss)
+# line: bytes
 def get_time(line):
-	fields = line.split(',')
+	fields = line.split(b',', 2)
 	return fields[1]
 
 if __name__ == '__main__':
-	# dict mapping time -> list of lines
-	lines_by_second = {}
-
 	parser = argparse.ArgumentParser(description='janky replay of hackrf_sweep logs to simulate a live hackrf_sweep')
 	parser.add_argument('file', help='hackrf_sweep logfile to replay')
 
 	args = parser.parse_args()
 
-	# group lines by time (expected format: hh:mm:ss)
-	with open(args.file, 'r') as f:
+	# hackrf_sweep logs are already in time order, so stream lines out as
+	# we read them, pausing a second whenever the time changes
+	# (expected format: hh:mm:ss). Nothing is held in memory.
+	# Lines are passed through as bytes, never decoded to str and back.
+	out = sys.stdout.buffer
+	prev_t = None
+	with open(args.file, 'rb') as f:
 		for l in f:
 			t = get_time(l)
-			try:
-				lines_by_second[t].append(l)
-			except KeyError:
-				lines_by_second[t] = []
-
-	# output each second's lines, in the order indicated by timestamps.
-	for k in sorted(lines_by_second.keys()):
-		for l in lines_by_second[k]:
-			print(l.rstrip())
-		time.sleep(1)
+			if prev_t is not None and t != prev_t:
+				# get the whole second out before we wait
+				out.flush()
+				time.sleep(1)
+			out.write(l)
+			prev_t = t
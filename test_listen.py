@@ -0,0 +1,50 @@
+#!/usr/bin/env python3
+#
+# checks of the drone detection heuristic in listen.py
+# run with pytest, or directly: ./test_listen.py
+
+import numpy as np
+
+from listen import get_contiguous_regions, get_drone_regions
+
+# hackrf_sweep -f 2403:2478 gives 1MHz buckets
+BUCKET_WIDTH = 1000000
+HZ_LOW = 2403000000 + BUCKET_WIDTH * np.arange(75, dtype=np.int64)
+BUCKET_RANGES = np.stack((HZ_LOW, HZ_LOW + BUCKET_WIDTH), axis=1)
+
+# buckets [start, end) have signal, nothing else does
+def signal_mask(start, end):
+	has_signal = np.zeros(len(BUCKET_RANGES), dtype=bool)
+	has_signal[start:end] = True
+	return has_signal
+
+def drone_regions(has_signal):
+	return get_drone_regions(get_contiguous_regions(BUCKET_RANGES, has_signal))
+
+# one noisy bucket above squelch isn't a video downlink
+def test_single_bucket_spike_is_not_drone():
+	assert len(drone_regions(signal_mask(7, 8))) == 0
+	assert len(drone_regions(signal_mask(74, 75))) == 0
+
+# neither are several narrow signals
+def test_scattered_buckets_are_not_drone():
+	has_signal = signal_mask(0, 0)
+	has_signal[[3, 5, 20, 21, 40]] = True
+	assert len(drone_regions(has_signal)) == 0
+
+# 10MHz wide is the narrowest DJI video downlink, so it counts,
+# but anything narrower doesn't
+def test_ten_mhz_is_threshold():
+	regions = drone_regions(signal_mask(30, 40))
+	assert regions.tolist() == [[2433000000, 2443000000]]
+	assert len(drone_regions(signal_mask(30, 39))) == 0
+
+def test_twenty_mhz_is_drone():
+	regions = drone_regions(signal_mask(50, 70))
+	assert regions.tolist() == [[2453000000, 2473000000]]
+
+if __name__ == '__main__':
+	for name, f in list(globals().items()):
+		if name.startswith('test_'):
+			f()
+	print("ok")